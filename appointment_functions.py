@@ -5,9 +5,16 @@ Professional appointment scheduling and visa information system
 for Axoraco Visa Consultants.
 """
 
+import asyncio
+import base64
+import calendar
+import os
 import random
-import string
-from datetime import datetime, timedelta
+import re
+from collections import deque
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from functools import lru_cache, partial
 from typing import Optional
 import logging
 
@@ -34,119 +41,224 @@ VISA_INFO = {
         "name": "Tourist Visa",
         "consultation_fee": "$50",
         "processing_time": "5-15 business days",
-        "common_requirements": [
+        "common_requirements": (
             "Valid passport (6+ months validity)",
             "Passport-size photographs",
             "Proof of accommodation",
             "Travel itinerary",
             "Bank statements (3 months)",
             "Travel insurance"
-        ],
+        ),
         "description": "Perfect for leisure travel, visiting family, or short vacations abroad."
     },
     "student": {
         "name": "Student Visa",
         "consultation_fee": "$75",
         "processing_time": "2-8 weeks",
-        "common_requirements": [
+        "common_requirements": (
             "Acceptance letter from institution",
             "Proof of financial support",
             "Academic transcripts",
             "Language proficiency test scores",
             "Valid passport",
             "Medical examination"
-        ],
+        ),
         "description": "For pursuing education abroad at universities, colleges, or language schools."
     },
     "work": {
         "name": "Work Visa",
         "consultation_fee": "$100",
         "processing_time": "4-12 weeks",
-        "common_requirements": [
+        "common_requirements": (
             "Job offer letter",
             "Employment contract",
             "Employer sponsorship documents",
             "Professional qualifications",
             "Work experience certificates",
             "Background check"
-        ],
+        ),
         "description": "For employment opportunities in foreign countries."
     },
     "business": {
         "name": "Business Visa",
         "consultation_fee": "$75",
         "processing_time": "1-4 weeks",
-        "common_requirements": [
+        "common_requirements": (
             "Business invitation letter",
             "Company registration documents",
             "Purpose of visit letter",
             "Bank statements",
             "Previous travel history"
-        ],
+        ),
         "description": "For business meetings, conferences, and professional engagements abroad."
     },
     "immigration": {
         "name": "Immigration Consulting",
         "consultation_fee": "$150",
         "processing_time": "Varies by program",
-        "common_requirements": [
+        "common_requirements": (
             "Varies by destination country",
             "Points-based assessment",
             "Language proficiency",
             "Work experience evaluation",
             "Educational credential assessment"
-        ],
+        ),
         "description": "Comprehensive guidance for permanent residency and citizenship applications."
     }
 }
 
+# Precomputed response fragments for get_visa_info and get_available_slots
+for _info in VISA_INFO.values():
+    _info["_requirements_preview"] = ", ".join(_info["common_requirements"][:3])
+    _info["_summary"] = (
+        f"{_info['name']}: {_info['description']} "
+        f"Our consultation fee is {_info['consultation_fee']} and typical processing time is {_info['processing_time']}. "
+        f"Common requirements include: {_info['_requirements_preview']} and more. "
+    )
+    _info["_fee_sentence"] = f" A {_info['name']} consultation is {_info['consultation_fee']}."
+del _info
+_VISA_NAMES_TEXT = ", ".join(v["name"] for v in VISA_INFO.values())
+
+@dataclass(slots=True)
+class Appointment:
+    """A booked consultation as stored in APPOINTMENTS."""
+    customer_name: str
+    phone_number: str
+    date: str
+    day: str
+    time: str
+    visa_type: str
+    fee: str
+    status: str
+    created_at: str
+    cancellation_reason: str = ""
+
+
 # In-memory appointment storage
-APPOINTMENTS = {}
-CALLBACK_REQUESTS = []
+APPOINTMENTS = {}  # confirmation code -> Appointment
+APPOINTMENTS_BY_PHONE = {}  # normalized phone -> confirmation codes, in booking order
+APPOINTMENTS_BY_DATE = {}  # formatted date -> set of confirmation codes
+CANCELLED_RETENTION_DAYS = 30
+
+# Held by handlers that update a booking together with its indexes. Those
+# handlers run on the event loop; read-only handlers stay lock-free.
+_STATE_LOCK = asyncio.Lock()
+MAX_CALLBACK_REQUESTS = 10_000
+CALLBACK_REQUESTS = deque(maxlen=MAX_CALLBACK_REQUESTS)  # oldest requests drop off first
+
+# Immutable per-day slot tuples for get_available_slots
+_ALL_SLOT_SETS = {day: tuple(slots) for day, slots in BUSINESS_HOURS.items()}
+
+# Private generator for simulated availability, independent of the global one
+_rng = random.Random()
+
+# Date parsing lookups, built once at import
+_WEEKDAYS = {
+    "monday": 0, "tuesday": 1, "wednesday": 2, "thursday": 3,
+    "friday": 4, "saturday": 5, "sunday": 6,
+}
+_MONTHS = {name.lower(): i for i, name in enumerate(calendar.month_name) if name}
+_MONTHS.update({name.lower(): i for i, name in enumerate(calendar.month_abbr) if name})
+_NUMERIC_DATE_RE = re.compile(r"(\d{1,2})/(\d{1,2})")      # "12/26" or "26/12"
+_MONTH_DATE_RE = re.compile(r"([a-z]{3,9})\s+(\d{1,2})")  # "december 26" or "dec 26"
+
+# Visa type aliases: every key, each prefix of 3+ letters, and common synonyms
+_VISA_ALIASES = {
+    key[:end]: key
+    for key in VISA_INFO
+    for end in range(3, len(key) + 1)
+}
+_VISA_ALIASES.update({
+    "visit": "tourist",
+    "travel": "tourist",
+    "study": "student",
+    "job": "work",
+    "employment": "work",
+    "immigrant": "immigration",
+})
 
 # =============================================================================
 # HELPER FUNCTIONS
 # =============================================================================
 
 def generate_confirmation_code() -> str:
-    """Generate a unique 6-character confirmation code."""
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+    """Generate a unique 6-character confirmation code (A-Z, 2-7)."""
+    return base64.b32encode(os.urandom(5))[:6].decode('ascii')
 
 
-def parse_date(date_str: str) -> tuple[str, str]:
-    """Parse natural language date to day name and formatted date."""
-    today = datetime.now()
-    date_lower = date_str.lower().strip()
+def _resolve_visa(visa_type: str) -> Optional[str]:
+    """Map a spoken visa type to its VISA_INFO key, or None if unrecognized."""
+    visa_key = visa_type.lower().strip()
+    key = _VISA_ALIASES.get(visa_key)
+    if key is not None:
+        return key
     
+    # Fall back to matching partial visa types
+    for key in VISA_INFO:
+        if key in visa_key or visa_key in key:
+            return key
+    return None
+
+
+def _format_slots(slots: list[str]) -> str:
+    """Join slots into spoken form, e.g. "9:00 AM, 10:00 AM and 2:00 PM"."""
+    if len(slots) > 1:
+        return ", ".join(slots[:-1]) + " and " + slots[-1]
+    return slots[0]
+
+
+def normalize_phone(phone_number: str) -> str:
+    """Reduce a phone number to its digits so lookups ignore formatting."""
+    return "".join(ch for ch in phone_number if ch.isdigit())
+
+
+def _next_occurrence(month: int, day: int, today: date) -> Optional[date]:
+    """Return the next month/day on or after today, or None if it is not a valid date."""
+    for year in (today.year, today.year + 1):
+        try:
+            target = date(year, month, day)
+        except ValueError:
+            continue
+        if target >= today:
+            return target
+    return None
+
+
+def parse_date(date_str: str, now: Optional[datetime] = None) -> tuple[str, str]:
+    """Parse natural language date to day name and formatted date."""
+    if now is None:
+        now = datetime.now()
+    return _parse_date(date_str.lower().strip(), now.date())
+
+
+@lru_cache(maxsize=256)
+def _parse_date(date_lower: str, today: date) -> tuple[str, str]:
+    """Cached worker for parse_date, keyed on today's date so results roll over at midnight."""
     if date_lower == "today":
         target = today
     elif date_lower == "tomorrow":
         target = today + timedelta(days=1)
-    elif date_lower in ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]:
+    elif date_lower in _WEEKDAYS:
         # Find next occurrence of this day
-        days = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
-        target_day = days.index(date_lower)
-        current_day = today.weekday()
-        days_ahead = (target_day - current_day) % 7
+        days_ahead = (_WEEKDAYS[date_lower] - today.weekday()) % 7
         if days_ahead == 0:
             days_ahead = 7  # Next week if same day
         target = today + timedelta(days=days_ahead)
     else:
-        # Try to parse as date
-        try:
-            for fmt in ["%B %d", "%b %d", "%m/%d", "%d/%m"]:
-                try:
-                    parsed = datetime.strptime(date_str, fmt)
-                    target = parsed.replace(year=today.year)
-                    if target < today:
-                        target = target.replace(year=today.year + 1)
-                    break
-                except ValueError:
-                    continue
-            else:
-                target = today + timedelta(days=1)  # Default to tomorrow
-        except:
-            target = today + timedelta(days=1)
+        # Classify the date shape up front instead of probing strptime formats
+        target = None
+        match = _NUMERIC_DATE_RE.fullmatch(date_lower)
+        if match:
+            first, second = int(match[1]), int(match[2])
+            # Month first, falling back to day first
+            target = _next_occurrence(first, second, today) or _next_occurrence(second, first, today)
+        else:
+            match = _MONTH_DATE_RE.fullmatch(date_lower)
+            if match and match[1] in _MONTHS:
+                target = _next_occurrence(_MONTHS[match[1]], int(match[2]), today)
+        
+        if target is None:
+            target = today + timedelta(days=1)  # Default to tomorrow
     
     day_name = target.strftime("%A")
     formatted_date = target.strftime("%B %d, %Y")
@@ -165,20 +277,29 @@ def get_available_slots(date: str, visa_type: Optional[str] = None) -> str:
         if day_name not in BUSINESS_HOURS or not BUSINESS_HOURS[day_name]:
             return f"I'm sorry, we're closed on {day_name}s. Our office hours are Monday through Friday 9 AM to 6 PM, and Saturday 10 AM to 2 PM. Would you like to check another day?"
         
-        # Simulate some slots being taken
-        all_slots = BUSINESS_HOURS[day_name].copy()
-        available = [s for s in all_slots if random.random() > 0.3]  # 70% availability
+        # Simulate some slots being taken (70% availability), keeping slot order
+        all_slots = _ALL_SLOT_SETS[day_name]
+        picked = sorted(_rng.sample(range(len(all_slots)), int(len(all_slots) * 0.7)))
+        
+        # Never offer a time that is already booked. This runs in a worker
+        # thread, so read a snapshot of the index rather than the live set.
+        codes = tuple(APPOINTMENTS_BY_DATE.get(formatted_date, ()))
+        booked = {
+            apt.time
+            for apt in map(APPOINTMENTS.get, codes)
+            if apt and apt.status == "confirmed"
+        }
+        available = [all_slots[i] for i in picked if all_slots[i] not in booked]
         
         if not available:
             return f"I'm sorry, we're fully booked on {formatted_date}. Would you like to check the next available day?"
         
-        slots_text = ", ".join(available[:-1]) + f" and {available[-1]}" if len(available) > 1 else available[0]
-        
-        response = f"For {formatted_date}, we have appointments available at {slots_text}."
+        response = f"For {formatted_date}, we have appointments available at {_format_slots(available)}."
         
-        if visa_type and visa_type.lower() in VISA_INFO:
-            info = VISA_INFO[visa_type.lower()]
-            response += f" A {info['name']} consultation is {info['consultation_fee']}."
+        visa_key = _resolve_visa(visa_type) if visa_type else None
+        if visa_key:
+            info = VISA_INFO[visa_key]
+            response += info["_fee_sentence"]
         
         response += " Which time works best for you?"
         return response
@@ -188,43 +309,57 @@ def get_available_slots(date: str, visa_type: Optional[str] = None) -> str:
         return "I'm having trouble checking availability. Let me connect you with our team. Can I get your phone number for a callback?"
 
 
-def book_appointment(customer_name: str, phone_number: str, date: str, time: str, visa_type: str) -> str:
+_BOOK_TEMPLATE = (
+    "Perfect! I've booked your {name} consultation. "
+    "Your appointment is confirmed for {date} at {time}. "
+    "Your confirmation code is {code}. "
+    "The consultation fee is {fee}, payable at the office. "
+    "We'll send a confirmation to {phone}. "
+    "Is there anything else I can help you with?"
+)
+
+
+async def book_appointment(customer_name: str, phone_number: str, date: str, time: str, visa_type: str) -> str:
     """Book a consultation appointment."""
     try:
-        day_name, formatted_date = parse_date(date)
+        now = datetime.now()
+        day_name, formatted_date = parse_date(date, now)
         
         # Validate day is not Sunday
         if day_name == "Sunday":
             return "I'm sorry, we're closed on Sundays. Would you like to book for another day?"
         
-        # Generate confirmation
-        confirmation_code = generate_confirmation_code()
-        
         # Get visa info
-        visa_info = VISA_INFO.get(visa_type.lower(), VISA_INFO["tourist"])
-        
-        # Store appointment
-        APPOINTMENTS[confirmation_code] = {
-            "customer_name": customer_name,
-            "phone_number": phone_number,
-            "date": formatted_date,
-            "day": day_name,
-            "time": time,
-            "visa_type": visa_info["name"],
-            "fee": visa_info["consultation_fee"],
-            "status": "confirmed",
-            "created_at": datetime.now().isoformat()
-        }
+        visa_info = VISA_INFO.get(_resolve_visa(visa_type), VISA_INFO["tourist"])
+        
+        async with _STATE_LOCK:
+            # Generate confirmation
+            confirmation_code = generate_confirmation_code()
+            
+            # Store appointment
+            APPOINTMENTS[confirmation_code] = Appointment(
+                customer_name=customer_name,
+                phone_number=phone_number,
+                date=formatted_date,
+                day=day_name,
+                time=time,
+                visa_type=visa_info["name"],
+                fee=visa_info["consultation_fee"],
+                status="confirmed",
+                created_at=now.isoformat(),
+            )
+            APPOINTMENTS_BY_PHONE.setdefault(normalize_phone(phone_number), []).append(confirmation_code)
+            APPOINTMENTS_BY_DATE.setdefault(formatted_date, set()).add(confirmation_code)
         
         logger.info(f"Appointment booked: {confirmation_code} for {customer_name}")
         
-        return (
-            f"Perfect! I've booked your {visa_info['name']} consultation. "
-            f"Your appointment is confirmed for {formatted_date} at {time}. "
-            f"Your confirmation code is {confirmation_code}. "
-            f"The consultation fee is {visa_info['consultation_fee']}, payable at the office. "
-            f"We'll send a confirmation to {phone_number}. "
-            f"Is there anything else I can help you with?"
+        return _BOOK_TEMPLATE.format(
+            name=visa_info["name"],
+            date=formatted_date,
+            time=time,
+            code=confirmation_code,
+            fee=visa_info["consultation_fee"],
+            phone=phone_number,
         )
         
     except Exception as e:
@@ -235,23 +370,14 @@ def book_appointment(customer_name: str, phone_number: str, date: str, time: str
 def get_visa_info(visa_type: str, destination_country: Optional[str] = None) -> str:
     """Get information about a specific visa type."""
     try:
-        visa_key = visa_type.lower().strip()
+        visa_key = _resolve_visa(visa_type)
         
-        # Match partial visa types
-        for key in VISA_INFO:
-            if key in visa_key or visa_key in key:
-                visa_key = key
-                break
-        
-        if visa_key not in VISA_INFO:
-            available = ", ".join([v["name"] for v in VISA_INFO.values()])
-            return f"I can help with: {available}. Which type of visa are you interested in?"
+        if visa_key is None:
+            return f"I can help with: {_VISA_NAMES_TEXT}. Which type of visa are you interested in?"
         
         info = VISA_INFO[visa_key]
         
-        response = f"{info['name']}: {info['description']} "
-        response += f"Our consultation fee is {info['consultation_fee']} and typical processing time is {info['processing_time']}. "
-        response += f"Common requirements include: {', '.join(info['common_requirements'][:3])} and more. "
+        response = info["_summary"]
         
         if destination_country:
             response += f"Requirements can vary for {destination_country}, so I'd recommend booking a consultation for personalized guidance. "
@@ -268,26 +394,29 @@ def get_visa_info(visa_type: str, destination_country: Optional[str] = None) ->
 def check_appointment(confirmation_code: Optional[str] = None, phone_number: Optional[str] = None) -> str:
     """Check details of an existing appointment."""
     try:
-        if confirmation_code and confirmation_code.upper() in APPOINTMENTS:
-            apt = APPOINTMENTS[confirmation_code.upper()]
+        code = confirmation_code.upper().strip() if confirmation_code else None
+        apt = APPOINTMENTS.get(code)
+        if apt:
             return (
                 f"I found your appointment. "
-                f"{apt['customer_name']}, you have a {apt['visa_type']} consultation "
-                f"on {apt['date']} at {apt['time']}. "
-                f"Status: {apt['status']}. "
+                f"{apt.customer_name}, you have a {apt.visa_type} consultation "
+                f"on {apt.date} at {apt.time}. "
+                f"Status: {apt.status}. "
                 f"Is there anything you'd like to change?"
             )
         
         if phone_number:
             # Search by phone
-            for code, apt in APPOINTMENTS.items():
-                if apt["phone_number"] == phone_number:
-                    return (
-                        f"I found an appointment for {apt['customer_name']}. "
-                        f"Your {apt['visa_type']} consultation is on {apt['date']} at {apt['time']}. "
-                        f"Confirmation code: {code}. "
-                        f"Would you like to make any changes?"
-                    )
+            codes = APPOINTMENTS_BY_PHONE.get(normalize_phone(phone_number))
+            if codes:
+                code = codes[0]
+                apt = APPOINTMENTS[code]
+                return (
+                    f"I found an appointment for {apt.customer_name}. "
+                    f"Your {apt.visa_type} consultation is on {apt.date} at {apt.time}. "
+                    f"Confirmation code: {code}. "
+                    f"Would you like to make any changes?"
+                )
         
         return "I couldn't find an appointment with those details. Could you please provide your confirmation code or the phone number used for booking?"
         
@@ -296,22 +425,23 @@ def check_appointment(confirmation_code: Optional[str] = None, phone_number: Opt
         return "I'm having trouble looking up your appointment. Can you provide your confirmation code?"
 
 
-def cancel_appointment(confirmation_code: str, reason: Optional[str] = None) -> str:
+async def cancel_appointment(confirmation_code: str, reason: Optional[str] = None) -> str:
     """Cancel an existing appointment."""
     try:
         code = confirmation_code.upper().strip()
         
-        if code not in APPOINTMENTS:
-            return "I couldn't find an appointment with that confirmation code. Could you please verify the code?"
-        
-        apt = APPOINTMENTS[code]
-        apt["status"] = "cancelled"
-        apt["cancellation_reason"] = reason or "Not provided"
+        async with _STATE_LOCK:
+            if code not in APPOINTMENTS:
+                return "I couldn't find an appointment with that confirmation code. Could you please verify the code?"
+            
+            apt = APPOINTMENTS[code]
+            apt.status = "cancelled"
+            apt.cancellation_reason = reason or "Not provided"
         
         logger.info(f"Appointment cancelled: {code}")
         
         return (
-            f"I've cancelled your {apt['visa_type']} consultation that was scheduled for {apt['date']} at {apt['time']}. "
+            f"I've cancelled your {apt.visa_type} consultation that was scheduled for {apt.date} at {apt.time}. "
             f"If you'd like to reschedule, I'm happy to help you find a new time. "
             f"Is there anything else I can assist with?"
         )
@@ -349,27 +479,74 @@ def request_callback(customer_name: str, phone_number: str, inquiry_type: Option
         return "I'm having trouble processing your request. Please try calling back or visit our website."
 
 
+# =============================================================================
+# HOUSEKEEPING
+# =============================================================================
+
+async def evict_cancelled_appointments(max_age_days: int = CANCELLED_RETENTION_DAYS) -> int:
+    """Drop cancelled appointments booked more than max_age_days ago. Returns the count."""
+    cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+    
+    async with _STATE_LOCK:
+        # APPOINTMENTS is in booking order, so stop at the first recent entry
+        stale = []
+        for code, apt in APPOINTMENTS.items():
+            if apt.created_at >= cutoff:
+                break
+            if apt.status == "cancelled":
+                stale.append(code)
+        
+        for code in stale:
+            apt = APPOINTMENTS.pop(code)
+            
+            phone_key = normalize_phone(apt.phone_number)
+            codes = APPOINTMENTS_BY_PHONE.get(phone_key, [])
+            if code in codes:
+                codes.remove(code)
+            if not codes:
+                APPOINTMENTS_BY_PHONE.pop(phone_key, None)
+            
+            date_codes = APPOINTMENTS_BY_DATE.get(apt.date, set())
+            date_codes.discard(code)
+            if not date_codes:
+                APPOINTMENTS_BY_DATE.pop(apt.date, None)
+    
+    if stale:
+        logger.info(f"Evicted {len(stale)} cancelled appointments")
+    return len(stale)
+
+
 # =============================================================================
 # FUNCTION DISPATCHER
 # =============================================================================
 
-def execute_function(function_name: str, parameters: dict) -> str:
-    """Dispatch function calls from Deepgram to the appropriate handler."""
-    functions = {
-        "get_available_slots": get_available_slots,
-        "book_appointment": book_appointment,
-        "get_visa_info": get_visa_info,
-        "check_appointment": check_appointment,
-        "cancel_appointment": cancel_appointment,
-        "request_callback": request_callback,
-    }
+_DISPATCH = {
+    "get_available_slots": get_available_slots,
+    "book_appointment": book_appointment,
+    "get_visa_info": get_visa_info,
+    "check_appointment": check_appointment,
+    "cancel_appointment": cancel_appointment,
+    "request_callback": request_callback,
+}
+
+
+async def execute_function(function_name: str, parameters: dict) -> str:
+    """Dispatch function calls from Deepgram to the appropriate handler.
     
-    func = functions.get(function_name)
+    Coroutine handlers are awaited on the event loop; plain ones run in the
+    loop's default executor so they never block audio forwarding.
+    """
+    func = _DISPATCH.get(function_name)
     if func:
         try:
-            logger.info(f"Executing function: {function_name} with params: {parameters}")
-            result = func(**parameters)
-            logger.info(f"Function result: {result[:100]}...")
+            logger.info("Executing function: %s with params: %s", function_name, parameters)
+            if asyncio.iscoroutinefunction(func):
+                result = await func(**parameters)
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, partial(func, **parameters)
+                )
+            logger.info("Function result: %.100s...", result)
             return result
         except TypeError as e:
             logger.error(f"Parameter error in {function_name}: {e}")
@@ -397,7 +574,7 @@ if __name__ == "__main__":
     print(f"   {get_visa_info('student', 'Canada')}\n")
     
     print("3. Booking appointment:")
-    result = book_appointment("John Doe", "+1234567890", "Monday", "10:00 AM", "student")
+    result = asyncio.run(book_appointment("John Doe", "+1234567890", "Monday", "10:00 AM", "student"))
     print(f"   {result}\n")
     
     print("4. Requesting callback:")
@@ -9,14 +9,24 @@ Architecture:
 """
 
 import asyncio
-import base64
+import contextlib
 import json
 import os
 import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from aiohttp import web, WSMsgType
 import aiohttp
+import orjson
+import pybase64
 
-from appointment_functions import execute_function
+try:
+    import uvloop
+except ImportError:  # uvloop does not support Windows
+    uvloop = None
+
+from appointment_functions import evict_cancelled_appointments, execute_function
 
 # =============================================================================
 # CONFIGURATION
@@ -25,6 +35,16 @@ from appointment_functions import execute_function
 DEEPGRAM_API_KEY = os.getenv("DEEPGRAM_API_KEY")
 PORT = int(os.getenv("PORT", 5000))
 HOST = os.getenv("HOST", "0.0.0.0")
+FUNCTION_WORKERS = int(os.getenv("FUNCTION_WORKERS", 8))
+EVICTION_INTERVAL = int(os.getenv("EVICTION_INTERVAL", 3600))  # seconds
+
+# Deepgram audio chunks waiting for Twilio are merged into one media frame,
+# up to this many chunks per frame
+OUTBOUND_QUEUE_SIZE = 64
+OUTBOUND_BATCH_LIMIT = 8
+
+# Inbound audio is summarized in one log line per interval, not per frame
+AUDIO_STATS_INTERVAL = 5  # seconds
 
 # Logging setup
 logging.basicConfig(
@@ -33,6 +53,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Deepgram agent settings, loaded once and sent verbatim to every call
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config.json')
+try:
+    with open(CONFIG_PATH, 'r') as f:
+        _CONFIG_TEXT = orjson.dumps(json.load(f)).decode('utf-8')
+except FileNotFoundError:
+    _CONFIG_TEXT = None
+
 
 # =============================================================================
 # HEALTH CHECK (for Render)
@@ -55,29 +83,60 @@ async def index(request):
 # DEEPGRAM CONNECTION
 # =============================================================================
 
-async def connect_to_deepgram():
+# One client session for all calls, so DNS results and connector state are
+# shared instead of being rebuilt for every call
+DEEPGRAM_SESSION = web.AppKey("deepgram_session", aiohttp.ClientSession)
+
+
+async def deepgram_session(app):
+    """Own the shared Deepgram ClientSession for the app's lifetime."""
+    app[DEEPGRAM_SESSION] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=1000, ttl_dns_cache=300, keepalive_timeout=60)
+    )
+    yield
+    await app[DEEPGRAM_SESSION].close()
+
+
+async def connect_to_deepgram(session):
     """Establish a WebSocket connection to Deepgram's Agent API."""
     if not DEEPGRAM_API_KEY:
         logger.error("DEEPGRAM_API_KEY not found!")
         return None
     
     try:
-        session = aiohttp.ClientSession()
         ws = await session.ws_connect(
             "wss://agent.deepgram.com/agent",
             headers={"Authorization": f"Token {DEEPGRAM_API_KEY}"}
         )
         logger.info("✅ Connected to Deepgram Agent API")
-        return ws, session
+        return ws
     except Exception as e:
         logger.error(f"❌ Failed to connect to Deepgram: {e}")
-        return None, None
+        return None
 
 
 # =============================================================================
 # TWILIO WEBSOCKET HANDLER
 # =============================================================================
 
+# Outbound media frames differ only in the base64 payload, so they are
+# assembled as UTF-8 bytes from a per-stream prefix instead of going through
+# json.dumps. Base64 never contains characters that need JSON escaping.
+_MEDIA_SUFFIX = b'"}}'
+
+
+def media_frame_prefix(stream_sid):
+    """Build the JSON bytes of a Twilio media frame up to its payload."""
+    return b'{"event":"media","streamSid":' + orjson.dumps(stream_sid) + b',"media":{"payload":"'
+
+
+# Inbound media frames make up nearly all Twilio traffic and only their
+# payload is needed, so it is pulled out without decoding the envelope.
+# Twilio sends the event field first; anything else takes the slow path.
+_MEDIA_PREFIX = '{"event":"media"'
+_PAYLOAD_RE = re.compile(r'"payload":"([A-Za-z0-9+/=]+)"')
+
+
 async def twilio_websocket_handler(request):
     """Handle WebSocket connection from Twilio."""
     ws = web.WebSocketResponse()
@@ -85,20 +144,20 @@ async def twilio_websocket_handler(request):
     
     logger.info("📞 New call connected from Twilio")
     
-    # Connect to Deepgram
-    result = await connect_to_deepgram()
-    if result[0] is None:
+    if _CONFIG_TEXT is None:
+        logger.error("config.json not found")
         await ws.close()
         return ws
     
-    deepgram_ws, session = result
+    # Connect to Deepgram
+    deepgram_ws = await connect_to_deepgram(request.app[DEEPGRAM_SESSION])
+    if deepgram_ws is None:
+        await ws.close()
+        return ws
     
-    # Load and send configuration
+    # Send configuration
     try:
-        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-        with open(config_path, 'r') as f:
-            config = json.load(f)
-        await deepgram_ws.send_json(config)
+        await deepgram_ws.send_str(_CONFIG_TEXT)
         logger.info("📋 Sent configuration to Deepgram")
     except Exception as e:
         logger.error(f"Config error: {e}")
@@ -106,90 +165,123 @@ async def twilio_websocket_handler(request):
         return ws
 
     stream_sid = None
+    media_prefix = media_frame_prefix(stream_sid)
+    outbound_audio = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
     
     async def receive_from_twilio():
-        nonlocal stream_sid
+        nonlocal stream_sid, media_prefix
+        media_frames = 0
+        stats_since = time.monotonic()
         try:
             async for msg in ws:
                 if msg.type == WSMsgType.TEXT:
-                    data = json.loads(msg.data)
+                    if msg.data.startswith(_MEDIA_PREFIX):
+                        match = _PAYLOAD_RE.search(msg.data)
+                        if match:
+                            await deepgram_ws.send_bytes(pybase64.b64decode(match.group(1)))
+                            
+                            media_frames += 1
+                            now = time.monotonic()
+                            if now - stats_since >= AUDIO_STATS_INTERVAL:
+                                logger.info("📊 %d media frames in %.0fs", media_frames, now - stats_since)
+                                media_frames = 0
+                                stats_since = now
+                            continue
+                    
+                    data = orjson.loads(msg.data)
                     event_type = data.get('event')
                     
                     if event_type == 'start':
                         stream_sid = data.get('streamSid')
-                        logger.info(f"🎙️ Stream started: {stream_sid}")
+                        media_prefix = media_frame_prefix(stream_sid)
+                        logger.info("🎙️ Stream started: %s", stream_sid)
                     
                     elif event_type == 'media':
                         payload = data['media']['payload']
-                        audio_bytes = base64.b64decode(payload)
+                        audio_bytes = pybase64.b64decode(payload)
                         await deepgram_ws.send_bytes(audio_bytes)
+                        media_frames += 1
                     
                     elif event_type == 'stop':
                         logger.info("📴 Call ended")
                         break
                         
                 elif msg.type == WSMsgType.ERROR:
-                    logger.error(f"WebSocket error: {ws.exception()}")
+                    logger.error("WebSocket error: %s", ws.exception())
                     break
         except Exception as e:
-            logger.error(f"Error receiving from Twilio: {e}")
+            logger.error("Error receiving from Twilio: %s", e)
     
     async def receive_from_deepgram():
         try:
             async for msg in deepgram_ws:
                 if msg.type == WSMsgType.BINARY:
-                    # Audio from Deepgram
-                    audio_b64 = base64.b64encode(msg.data).decode('utf-8')
-                    await ws.send_json({
-                        "event": "media",
-                        "streamSid": stream_sid,
-                        "media": {"payload": audio_b64}
-                    })
+                    # Audio from Deepgram, forwarded by send_to_twilio
+                    await outbound_audio.put(msg.data)
                 
                 elif msg.type == WSMsgType.TEXT:
-                    data = json.loads(msg.data)
+                    data = orjson.loads(msg.data)
                     msg_type = data.get('type')
                     
                     if msg_type == 'Welcome':
                         logger.info("🤝 Deepgram session established")
                     
                     elif msg_type == 'ConversationText':
-                        role = data.get('role', 'unknown')
-                        content = data.get('content', '')
-                        logger.info(f"💬 {role.upper()}: {content}")
+                        if logger.isEnabledFor(logging.INFO):
+                            role = data.get('role', 'unknown')
+                            logger.info("💬 %s: %s", role.upper(), data.get('content', ''))
                     
                     elif msg_type == 'FunctionCallRequest':
                         function_name = data.get('function_name')
                         function_call_id = data.get('function_call_id')
                         parameters = data.get('input', {})
                         
-                        logger.info(f"🔧 Function call: {function_name}({parameters})")
-                        result = execute_function(function_name, parameters)
-                        logger.info(f"📤 Function result: {result}")
+                        logger.info("🔧 Function call: %s(%s)", function_name, parameters)
+                        result = await execute_function(function_name, parameters)
+                        logger.info("📤 Function result: %s", result)
                         
-                        await deepgram_ws.send_json({
+                        # Deepgram expects control messages as text frames
+                        await deepgram_ws.send_str(orjson.dumps({
                             "type": "FunctionCallResponse",
                             "function_call_id": function_call_id,
                             "output": result
-                        })
+                        }).decode('utf-8'))
                     
                     elif msg_type == 'Error':
-                        logger.error(f"❌ Deepgram error: {data}")
+                        logger.error("❌ Deepgram error: %s", data)
                         
                 elif msg.type == WSMsgType.ERROR:
-                    logger.error(f"Deepgram WS error: {deepgram_ws.exception()}")
+                    logger.error("Deepgram WS error: %s", deepgram_ws.exception())
                     break
         except Exception as e:
-            logger.error(f"Error receiving from Deepgram: {e}")
+            logger.error("Error receiving from Deepgram: %s", e)
     
+    async def send_to_twilio():
+        try:
+            while True:
+                # Merge whatever audio is already queued, without waiting for more
+                chunks = [await outbound_audio.get()]
+                while len(chunks) < OUTBOUND_BATCH_LIMIT and not outbound_audio.empty():
+                    chunks.append(outbound_audio.get_nowait())
+                audio = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+                
+                # Sent as a text frame from ready-made bytes, skipping send_str's encode
+                frame = b"".join((media_prefix, pybase64.b64encode(audio), _MEDIA_SUFFIX))
+                await ws.send_frame(frame, WSMsgType.TEXT)
+        except Exception as e:
+            logger.error("Error sending to Twilio: %s", e)
+    
+    # The Twilio side runs on this handler's own task and decides when the
+    # call is over; the Deepgram reader and the sender are stopped with it.
+    deepgram_reader = asyncio.create_task(receive_from_deepgram())
+    sender = asyncio.create_task(send_to_twilio())
     try:
-        await asyncio.gather(
-            receive_from_twilio(),
-            receive_from_deepgram()
-        )
+        await receive_from_twilio()
     finally:
+        deepgram_reader.cancel()
+        sender.cancel()
+        await asyncio.gather(deepgram_reader, sender, return_exceptions=True)
         await deepgram_ws.close()
-        await session.close()
         logger.info("🔌 Call session ended")
     
     return ws
@@ -199,9 +291,33 @@ async def twilio_websocket_handler(request):
 # MAIN
 # =============================================================================
 
+async def init_executor(app):
+    """Size the default executor that runs function calls."""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=FUNCTION_WORKERS)
+    )
+
+
+async def appointment_housekeeping(app):
+    """Evict stale cancelled appointments periodically while the app runs."""
+    async def evict_periodically():
+        while True:
+            await asyncio.sleep(EVICTION_INTERVAL)
+            await evict_cancelled_appointments()
+    
+    task = asyncio.create_task(evict_periodically())
+    yield
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+
+
 def create_app():
     """Create the aiohttp application."""
     app = web.Application()
+    app.on_startup.append(init_executor)
+    app.cleanup_ctx.append(deepgram_session)
+    app.cleanup_ctx.append(appointment_housekeeping)
     app.router.add_get('/', index)
     app.router.add_get('/health', health_check)
     app.router.add_get('/twilio', twilio_websocket_handler)
@@ -220,5 +336,13 @@ if __name__ == "__main__":
 ╚══════════════════════════════════════════════════════════════╝
     """)
     
+    if _CONFIG_TEXT is None:
+        logger.error(f"config.json not found at {CONFIG_PATH}, refusing to start")
+        raise SystemExit(1)
+    
+    logger.info(f"Audio codec: pybase64 {pybase64.get_version()}")
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    
     app = create_app()
     web.run_app(app, host=HOST, port=PORT)